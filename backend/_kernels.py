@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Numba-ядра для горячих циклов пайплайна.
+
+Модуль опционален: если numba не установлена, импорт падает с ImportError,
+и вызывающий код откатывается на NumPy-реализацию.
+"""
+import numpy as np
+from numba import njit, prange
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def fuse_box_masks(points, centers, halves, cosy, siny, owner):
+    """
+    owner[i] = индекс первого бокса, содержащего точку i, либо -1.
+    Один проход по точкам тестирует все боксы сразу: B потоков памяти
+    схлопываются в один. Поворот только вокруг Z — крутим лишь x,y.
+    """
+    N = points.shape[0]
+    B = centers.shape[0]
+    for i in prange(N):
+        owner[i] = -1
+        x = points[i, 0]; y = points[i, 1]; z = points[i, 2]
+        for b in range(B):
+            px = x - centers[b, 0]
+            py = y - centers[b, 1]
+            pz = z - centers[b, 2]
+            rx = cosy[b]*px - siny[b]*py
+            ry = siny[b]*px + cosy[b]*py
+            if abs(rx) <= halves[b, 0] and abs(ry) <= halves[b, 1] and abs(pz) <= halves[b, 2]:
+                owner[i] = b
+                break
+
+
+@njit(fastmath=True, cache=True)
+def rasterize_max(x, y, h, minx, miny, res, img):
+    """
+    img[iy, ix] = max(h) по точкам клетки; ix/iy считаются и клипуются
+    на лету. Последовательный scatter-max (параллелить нельзя — гонка
+    записей в одну клетку), зато один проход по памяти без временных
+    ix/iy/lin массивов.
+    """
+    H, W = img.shape
+    inv_res = 1.0 / res
+    for i in range(x.shape[0]):
+        ix = int((x[i] - minx) * inv_res)
+        iy = int((y[i] - miny) * inv_res)
+        if ix < 0:
+            ix = 0
+        elif ix > W - 1:
+            ix = W - 1
+        if iy < 0:
+            iy = 0
+        elif iy > H - 1:
+            iy = H - 1
+        if h[i] > img[iy, ix]:
+            img[iy, ix] = h[i]
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def assign_points(pts, lo, hi, centers, out):
+    """
+    out[i] = индекс ближайшего (по центру) бокса, содержащего точку i, либо -1.
+    pts (N,3), lo/hi/centers (B,3) — float32; out (N,) int32.
+    """
+    N = pts.shape[0]
+    B = lo.shape[0]
+    for i in prange(N):
+        x = pts[i, 0]; y = pts[i, 1]; z = pts[i, 2]
+        best = -1
+        best_d2 = np.inf
+        for j in range(B):
+            if (lo[j, 0] <= x <= hi[j, 0] and
+                    lo[j, 1] <= y <= hi[j, 1] and
+                    lo[j, 2] <= z <= hi[j, 2]):
+                dx = x - centers[j, 0]
+                dy = y - centers[j, 1]
+                dz = z - centers[j, 2]
+                d2 = dx*dx + dy*dy + dz*dz
+                if d2 < best_d2:
+                    best_d2 = d2
+                    best = j
+        out[i] = best
@@ -1,60 +1,129 @@
 #!/usr/bin/env python3
-import argparse, os, json, numpy as np
+import argparse, os, json, shutil, numpy as np
 import open3d as o3d
+from scipy.spatial import cKDTree
+
+try:
+    from _kernels import assign_points as _assign_points_nb
+except ImportError:
+    _assign_points_nb = None
 
 def load_meta(meta_path):
     with open(meta_path, "r") as f:
         return json.load(f)
 
-def yolo_to_xyxy_conf(line, img_w, img_h):
+def read_points(pcd_path):
+    """Читает точки из .npy-сайдкара (mmap), если он есть, иначе декодирует PCD."""
+    npy = os.path.splitext(pcd_path)[0] + ".npy"
+    if os.path.exists(npy):
+        return np.load(npy, mmap_mode="r")
+    pcd = o3d.t.io.read_point_cloud(pcd_path)
+    return pcd.point.positions.numpy()
+
+def write_points(points, path):
+    """Пишет Nx3 точки через tensor-API (zero-copy из numpy)."""
+    pc = o3d.t.geometry.PointCloud(
+        o3d.core.Tensor(np.ascontiguousarray(points, dtype=np.float32)))
+    o3d.t.io.write_point_cloud(path, pc)
+
+def parse_yolo_boxes(lines, meta):
     """
-    YOLO TXT: class cx cy w h conf (нормализованные)
-    -> xmin,ymin,xmax,ymax,cls,conf
+    YOLO TXT (class cx cy w h conf, нормализованные) -> 3D-боксы одним заходом.
+
+    Возвращает (ids, confs, lo, hi, centers):
+      ids     — номера исходных строк (для имён inference_XX.pcd),
+      lo/hi   — (B,3) нижние/верхние углы AABB,
+      centers — (B,3) центры боксов в глобальных координатах.
+    Вся плоскостная математика считается массивами в float64.
     """
-    parts = line.strip().split()
-    if len(parts) < 6:
-        return None
-    cls, cx, cy, w, h, conf = map(float, parts[:6])
-    cx *= img_w
-    cy *= img_h
-    w *= img_w
-    h *= img_h
-    xmin = cx - w/2
-    xmax = cx + w/2
-    ymin = cy - h/2
-    ymax = cy + h/2
-    return int(xmin), int(ymin), int(xmax), int(ymax), int(cls), float(conf)
-
-def bbox_to_3d(xmin, ymin, xmax, ymax, meta):
-    """BBox в пикселях PNG -> 3D-бокс (ось-выравненный по XY, ограниченный по Z)."""
+    img_w, img_h = meta["width"], meta["height"]
+    rows, ids = [], []
+    for i, line in enumerate(lines):
+        parts = line.strip().split()
+        if len(parts) < 6:
+            continue
+        rows.append([float(v) for v in parts[:6]])
+        ids.append(i)
+    if not rows:
+        empty3 = np.zeros((0, 3))
+        return np.array([], dtype=int), np.array([]), empty3, empty3, empty3
+
+    data = np.asarray(rows, dtype=float)
+    ids = np.asarray(ids, dtype=int)
+    confs = data[:, 5]
+    # пиксельные границы (с тем же усечением к int, что и раньше)
+    cx = data[:, 1] * img_w; cy = data[:, 2] * img_h
+    w = data[:, 3] * img_w;  h = data[:, 4] * img_h
+    xmin = (cx - w/2).astype(int); xmax = (cx + w/2).astype(int)
+    ymin = (cy - h/2).astype(int); ymax = (cy + h/2).astype(int)
+
     ox, oy = meta["origin_xy"]
     res = meta["resolution"]
-    # XY границы
-    x0 = ox + xmin * res
-    x1 = ox + xmax * res
-    y0 = oy + ymin * res
-    y1 = oy + ymax * res
-
-    # Z: от плоскости до max_height
-    n = np.array(meta["plane"]["n"], dtype=float)
+    n0, n1, n2 = meta["plane"]["n"]
     D = float(meta["plane"]["D"])
     max_h = meta["max_height"]
-    cx = 0.5*(x0+x1)
-    cy = 0.5*(y0+y1)
-    z0 = (-D - n[0]*cx - n[1]*cy)/n[2] + 0.2
+
+    # XY границы в глобальных координатах
+    x0 = ox + xmin * res; x1 = ox + xmax * res
+    y0 = oy + ymin * res; y1 = oy + ymax * res
+    # Z: от плоскости до max_height; центр бокса — на плоскости
+    gx = 0.5 * (x0 + x1)
+    gy = 0.5 * (y0 + y1)
+    gz = (-D - n0*gx - n1*gy) / n2
+    z0 = gz + 0.2
     z1 = z0 + max_h
-    return (min(x0,x1), max(x0,x1)), (min(y0,y1), max(y0,y1)), (z0,z1)
 
-def points_in_box(pts, box):
-    (x0,x1), (y0,y1), (z0,z1) = box
-    return (pts[:,0]>=x0)&(pts[:,0]<=x1)&(pts[:,1]>=y0)&(pts[:,1]<=y1)&(pts[:,2]>=z0)&(pts[:,2]<=z1)
+    lo = np.stack([np.minimum(x0, x1), np.minimum(y0, y1), z0], axis=1)
+    hi = np.stack([np.maximum(x0, x1), np.maximum(y0, y1), z1], axis=1)
+    centers = np.stack([gx, gy, gz], axis=1)
+    return ids, confs, lo, hi, centers
 
-def main():
+def assign_points_to_boxes(pts, lo, hi, centers, chunk_size=200_000):
+    """
+    Для каждой точки — индекс бокса, в который она попала (-1, если ни в один).
+    Точки, попавшие в несколько боксов, отдаются ближайшему по центру.
+    kd-дерево по центрам отсекает точки, которые заведомо ни в один бокс
+    не попадают (дальше полудиагонали самого большого бокса), после чего
+    точный AABB-тест гоняется только по кандидатам — блоками по chunk_size,
+    чтобы маска (N,B) не раздувала память.
+
+    При установленной numba вся раздача делается JIT-ядром без (N,B)-масок.
+    """
+    owner = np.full(pts.shape[0], -1, dtype=np.int32)
+    if _assign_points_nb is not None:
+        _assign_points_nb(np.ascontiguousarray(pts, dtype=np.float32),
+                          lo.astype(np.float32), hi.astype(np.float32),
+                          centers.astype(np.float32), owner)
+        return owner
+    tree = cKDTree(centers)
+    half_diag = 0.5 * float(np.linalg.norm(hi - lo, axis=1).max())
+    dist, nearest = tree.query(pts, k=1, distance_upper_bound=half_diag, workers=-1)
+    cand_idx = np.flatnonzero(np.isfinite(dist))
+    for s in range(0, cand_idx.size, chunk_size):
+        idx = cand_idx[s:s+chunk_size]
+        p = pts[idx]
+        inside = np.all((p[:,None,:] >= lo[None,:,:]) & (p[:,None,:] <= hi[None,:,:]), axis=2)
+        counts = inside.sum(axis=1)
+        chunk_owner = np.where(counts > 0, np.argmax(inside, axis=1), -1)
+        multi = counts > 1
+        if np.any(multi):
+            # если глобально ближайший центр — один из кандидатов, берём его,
+            # иначе честный argmin по центрам содержащих боксов
+            near = nearest[idx[multi]]
+            rows = np.arange(near.size)
+            ok = inside[multi][rows, near]
+            d2 = ((p[multi][:,None,:] - centers[None,:,:])**2).sum(axis=-1)
+            d2 = np.where(inside[multi], d2, np.inf)
+            chunk_owner[multi] = np.where(ok, near, np.argmin(d2, axis=1))
+        owner[idx] = chunk_owner
+    return owner
+
+def main(argv=None):
     ap = argparse.ArgumentParser()
     ap.add_argument("--indir", required=True, help="Папка с split_pcd/nonground и heightmaps")
     ap.add_argument("--bboxes", required=True, help="Папка с YOLO txt файлами инференсов")
     ap.add_argument("--outdir", required=True, help="Куда сохранять результаты")
-    args = ap.parse_args()
+    args = ap.parse_args(argv)
 
     ng_dir = os.path.join(args.indir, "split_pcd/nonground")
     hm_dir = os.path.join(args.indir, "heightmaps")
@@ -75,100 +144,77 @@ def main():
         if not os.path.exists(bbox_path) or not os.path.exists(meta_path):
             continue
 
-        # облако
-        pcd = o3d.io.read_point_cloud(pcd_path)
-        pts = np.asarray(pcd.points)
-        if pts.shape[0] == 0:
-            continue
-
-        # метаданные
-        meta = load_meta(meta_path)
-        img_w, img_h = meta["width"], meta["height"]
-
-        # читаем bbox
+        # читаем bbox (до загрузки облака: пустой инференс его вообще не требует)
         with open(bbox_path) as f:
             lines = [l for l in f.readlines() if l.strip()]
         if not lines:
-            # пустой инференс → просто копируем чанк
+            # пустой инференс → чанк не меняется, хардлинк вместо перекодирования
             out_chunk_dir = os.path.join(args.outdir, f"chunk_{cid:04d}")
             os.makedirs(out_chunk_dir, exist_ok=True)
-            o3d.io.write_point_cloud(os.path.join(out_chunk_dir, "chunk_clean.pcd"), pcd)
+            clean_path = os.path.join(out_chunk_dir, "chunk_clean.pcd")
+            try:
+                if os.path.exists(clean_path):
+                    os.remove(clean_path)
+                os.link(pcd_path, clean_path)
+            except OSError:
+                shutil.copyfile(pcd_path, clean_path)
             print(f"[i] chunk {cid:04d}: empty bboxes, copied as-is")
             continue
 
+        # облако (float32: вдвое меньше трафика памяти на больших чанках;
+        # сайдкары и так float32)
+        pts = np.asarray(read_points(pcd_path), dtype=np.float32)
+        if pts.shape[0] == 0:
+            continue
+
+        # метаданные
+        meta = load_meta(meta_path)
+
         out_chunk_dir = os.path.join(args.outdir, f"chunk_{cid:04d}")
         os.makedirs(out_chunk_dir, exist_ok=True)
 
-        # подготовим боксы с центрами
-        bbox_defs = []
-        for i,line in enumerate(lines):
-            res = yolo_to_xyxy_conf(line, img_w, img_h)
-            if res is None: 
-                continue
-            xmin,ymin,xmax,ymax,cls,conf = res
-            box = bbox_to_3d(xmin,ymin,xmax,ymax, meta)
-            # центр в глобальных координатах
-            cx_pix = 0.5*(xmin+xmax)
-            cy_pix = 0.5*(ymin+ymax)
-            gx = meta["origin_xy"][0] + cx_pix * meta["resolution"]
-            gy = meta["origin_xy"][1] + cy_pix * meta["resolution"]
-            gz = (-float(meta["plane"]["D"]) - meta["plane"]["n"][0]*gx - meta["plane"]["n"][1]*gy)/meta["plane"]["n"][2]
-            bbox_defs.append({
-                "i": i, "box": box, "center": np.array([gx,gy,gz], dtype=float),
-                "conf": conf
-            })
+        # подготовим боксы: все строки парсятся в массивы одним заходом
+        ids, confs, lo, hi, centers = parse_yolo_boxes(lines, meta)
 
-        assignments = [[] for _ in bbox_defs]
-
-        # распределим точки
-        for idx,pt in enumerate(pts):
-            candidates = []
-            for b in bbox_defs:
-                if points_in_box(pt[None,:], b["box"])[0]:
-                    candidates.append(b)
-            if len(candidates) == 1:
-                assignments[candidates[0]["i"]].append(idx)
-            elif len(candidates) > 1:
-                dists = [np.linalg.norm(pt - b["center"]) for b in candidates]
-                chosen = candidates[int(np.argmin(dists))]
-                assignments[chosen["i"]].append(idx)
+        # распределим точки: один векторизованный проход по всем боксам
+        # (плоскостная математика остаётся в float64, сюда кладём уже float32)
+        if ids.size:
+            owner = assign_points_to_boxes(pts, lo.astype(np.float32),
+                                           hi.astype(np.float32),
+                                           centers.astype(np.float32))
+        else:
+            owner = np.full(pts.shape[0], -1, dtype=np.int32)
+        assignments = [np.flatnonzero(owner == j) for j in range(ids.size)]
 
         mask_remove = np.zeros(pts.shape[0], dtype=bool)
         inf_summaries = []
 
-        for b in bbox_defs:
-            inds = assignments[b["i"]]
-            if len(inds) == 0:
+        for j in range(ids.size):
+            inds = assignments[j]
+            if inds.size == 0:
                 continue
-            car_pts = pts[inds]
-            car_pcd = o3d.geometry.PointCloud()
-            car_pcd.points = o3d.utility.Vector3dVector(car_pts)
-            out_path = os.path.join(out_chunk_dir, f"inference_{b['i']:02d}.pcd")
-            o3d.io.write_point_cloud(out_path, car_pcd)
+            out_path = os.path.join(out_chunk_dir, f"inference_{ids[j]:02d}.pcd")
+            write_points(pts[inds], out_path)
             mask_remove[inds] = True
 
             # параметры параллелепипеда
-            (x0,x1),(y0,y1),(z0,z1) = b["box"]
-            center = [ (x0+x1)/2, (y0+y1)/2, (z0+z1)/2 ]
-            size   = [ x1-x0, y1-y0, z1-z0 ]
+            center = 0.5 * (lo[j] + hi[j])
+            size   = hi[j] - lo[j]
             yaw    = 0.0  # пока без поворота
 
             inf_summaries.append({
-                "id": b["i"],
-                "confidence": b["conf"],
+                "id": int(ids[j]),
+                "confidence": float(confs[j]),
                 "center": [float(c) for c in center],
                 "size": [float(s) for s in size],
                 "yaw": yaw,
-                "points": len(inds),
+                "points": int(inds.size),
                 "pcd_file": os.path.basename(out_path)
             })
 
         # сохраним очищенный чанк
-        clean_pts = pts[~mask_remove]
-        clean_pcd = o3d.geometry.PointCloud()
-        clean_pcd.points = o3d.utility.Vector3dVector(clean_pts)
         clean_path = os.path.join(out_chunk_dir, "chunk_clean.pcd")
-        o3d.io.write_point_cloud(clean_path, clean_pcd)
+        write_points(pts[~mask_remove], clean_path)
 
         chunk_summary = {
             "cid": cid,
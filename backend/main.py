@@ -1,17 +1,60 @@
+import asyncio
 import uuid
 import shutil
-import subprocess
 import os
 import re
 import json
+import traceback
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from fastapi import FastAPI, UploadFile, HTTPException, Body
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# стадии пайплайна вызываем in-process: без форка интерпретатора на шаг,
+# numpy/open3d/веса YOLO грузятся один раз на процесс сервера
+from kmeans_pcd import main as kmeans_main
+from ground_detection import main as ground_main
+from render_heightmaps import main as render_main
+from calculate_inference import main as inference_main
+from apply_inference import main as apply_main
+from process_pcd import main as process_main
+
 DATA_DIR = Path("data")
 BASE_URL = "/files"
 
+# паттерны имён файлов — компилируем один раз, а не в каждой итерации
+_CLUSTER_RE = re.compile(r"cluster_(\d+)_ground\.pcd")
+_INFER_RE = re.compile(r"inference_(\d+)\.pcd")
+
+# пайплайн — тяжёлый и синхронный; гоняем его в пуле потоков, чтобы не
+# блокировать event loop. Пул потоков (а не процессов): стадии сами
+# параллелятся внутри, а прогретая YOLO-модель живёт в этом же процессе.
+_EXECUTOR = ThreadPoolExecutor(max_workers=1)
+
+
+def _load_json(path):
+    if orjson is not None:
+        with open(path, "rb") as f:
+            return orjson.loads(f.read())
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def _dump_json(obj, path, indent=False):
+    if orjson is not None:
+        opt = orjson.OPT_INDENT_2 if indent else 0
+        with open(path, "wb") as f:
+            f.write(orjson.dumps(obj, option=opt))
+    else:
+        with open(path, "w") as f:
+            json.dump(obj, f, indent=2 if indent else None)
+
 app = FastAPI()
 
 app.add_middleware(
@@ -25,59 +68,50 @@ app.add_middleware(
 app.mount(BASE_URL, StaticFiles(directory="."), name="files")
 
 
-def run_step(cmd, cwd=None):
+def run_step(step_main, argv):
+    name = step_main.__module__
     try:
-        result = subprocess.run(
-            cmd,
-            check=True,
-            capture_output=True,
-            text=True,
-            cwd=cwd
-        )
-        print(f"[OK] {' '.join(cmd)}")
-        print(result.stdout)
-        return result
-    except subprocess.CalledProcessError as e:
-        print(f"[FAIL] {' '.join(cmd)}")
-        print("STDOUT:\n", e.stdout)
-        print("STDERR:\n", e.stderr)
+        step_main(argv)
+        print(f"[OK] {name} {' '.join(argv)}")
+    except HTTPException:
+        raise
+    except Exception:
+        tb = traceback.format_exc()
+        print(f"[FAIL] {name} {' '.join(argv)}")
+        print(tb)
         raise HTTPException(
             status_code=500,
             detail={
                 "status": "error",
-                "command": " ".join(cmd),
-                "stdout": e.stdout,
-                "stderr": e.stderr
+                "step": name,
+                "argv": argv,
+                "traceback": tb
             }
         )
 
 
 def run_pipeline(input_path: Path, job_dir: Path):
-    run_step([
-        "python3", "kmeans_pcd.py",
+    run_step(kmeans_main, [
         "--pcd", str(input_path),
         "--keep_ratio", "0.01",
         "--target_points_per_cluster", "100000",
         "--outdir", str(job_dir)
     ])
 
-    run_step([
-        "python3", "ground_detection.py",
+    run_step(ground_main, [
         "--indir", str(job_dir),
         "--report_json", "ground_report.json",
         "--save_split", "--split_outdir", "split_pcd",
         "--split_dist", "0.20"
     ])
 
-    run_step([
-        "python3", "render_heightmaps.py",
+    run_step(render_main, [
         "--indir", str(job_dir),
         "--res", "0.2", "--max_height", "3.0",
         "--cap_mode", "drop", "--bits", "8"
     ])
 
-    run_step([
-        "python3", "calculate_inference.py",
+    run_step(inference_main, [
         "--indir", str(job_dir),
         "--weights", "weights/first.pt",
         "--images_dir", "heightmaps",
@@ -85,8 +119,7 @@ def run_pipeline(input_path: Path, job_dir: Path):
         "--conf", "0.3"
     ])
 
-    run_step([
-        "python3", "apply_inference.py",
+    run_step(apply_main, [
         "--indir", str(job_dir),
         "--bboxes", str(job_dir / "yolo_labels"),
         "--outdir", str(job_dir / "labels_pcd")
@@ -100,17 +133,18 @@ def collect_results(job_dir: Path):
     nonground_dir = job_dir / "split_pcd" / "nonground"
     labels_dir = job_dir / "labels_pcd"
 
-    # читаем расширенные данные
+    # читаем расширенные данные: плоский индекс (cid, inf_id) -> запись
+    # вместо dict-of-dict — один hash-lookup и меньше питоновских объектов
     summary_file = labels_dir / "all_summary.json"
-    summary_data = {}
+    summary_idx = {}
+    summary_recs = []
     if summary_file.exists():
-        with open(summary_file) as f:
-            raw = json.load(f)
+        raw = _load_json(summary_file)
         for chunk in raw:
             cid = chunk.get("cid")
-            inferences = chunk.get("inferences", [])
-            summary_data[cid] = {
-                inf["id"]: {
+            for inf in chunk.get("inferences", []):
+                summary_idx[(cid, inf["id"])] = len(summary_recs)
+                summary_recs.append({
                     "confidence": inf["confidence"],
                     "points": inf["points"],
                     "bounding_box": {
@@ -118,41 +152,55 @@ def collect_results(job_dir: Path):
                         "size": inf["size"],
                         "yaw": inf["yaw"],
                     }
-                }
-                for inf in inferences
-            }
+                })
 
-    ground_files = list(ground_dir.glob("cluster_*_ground.pcd"))
-    for gf in sorted(ground_files):
-        m = re.search(r"cluster_(\d+)_ground\.pcd", gf.name)
+    # os.scandir вместо glob: один проход по каталогу без лишних stat'ов
+    try:
+        with os.scandir(ground_dir) as it:
+            ground_files = sorted(
+                (e for e in it
+                 if e.name.startswith("cluster_") and e.name.endswith("_ground.pcd")),
+                key=lambda e: e.name)
+    except FileNotFoundError:
+        ground_files = []
+
+    for gf in ground_files:
+        m = _CLUSTER_RE.search(gf.name)
         if not m:
             continue
         chunk_id = int(m.group(1))
 
-        ground_path = f"{BASE_URL}/{gf.relative_to(Path('.')).as_posix()}"
+        ground_path = f"{BASE_URL}/{Path(gf.path).as_posix()}"
 
-        # static
+        # содержимое chunk-каталога — одним scandir (и exists, и список inference)
         label_chunk_dir = labels_dir / f"chunk_{chunk_id:04d}"
-        if (label_chunk_dir / "chunk_clean.pcd").exists():
-            static_path = f"{BASE_URL}/{(label_chunk_dir / 'chunk_clean.pcd').relative_to(Path('.')).as_posix()}"
+        try:
+            with os.scandir(label_chunk_dir) as it:
+                chunk_entries = {e.name: e.path for e in it}
+        except FileNotFoundError:
+            chunk_entries = None
+
+        # static
+        if chunk_entries is not None and "chunk_clean.pcd" in chunk_entries:
+            static_path = f"{BASE_URL}/{(label_chunk_dir / 'chunk_clean.pcd').as_posix()}"
         else:
-            static_path = f"{BASE_URL}/{(nonground_dir / f'cluster_{chunk_id:04d}_nonground.pcd').relative_to(Path('.')).as_posix()}"
+            static_path = f"{BASE_URL}/{(nonground_dir / f'cluster_{chunk_id:04d}_nonground.pcd').as_posix()}"
 
         # dynamic
         dynamic = []
-        if label_chunk_dir.exists():
-            for inf in sorted(label_chunk_dir.glob("inference_*.pcd")):
-                m2 = re.search(r"inference_(\d+)\.pcd", inf.name)
+        if chunk_entries is not None:
+            for name in sorted(chunk_entries):
+                m2 = _INFER_RE.search(name)
                 if not m2:
                     continue
                 inf_id = int(m2.group(1))
                 obj = {
-                    "url": f"{BASE_URL}/{inf.relative_to(Path('.')).as_posix()}",
+                    "url": f"{BASE_URL}/{Path(chunk_entries[name]).as_posix()}",
                     "inference": inf_id,
                 }
-                extra = summary_data.get(chunk_id, {}).get(inf_id)
-                if extra:
-                    obj.update(extra)
+                i = summary_idx.get((chunk_id, inf_id))
+                if i is not None:
+                    obj.update(summary_recs[i])
                 dynamic.append(obj)
 
         results.append({
@@ -174,11 +222,17 @@ async def process_pcd(file: UploadFile):
     DATA_DIR.mkdir(exist_ok=True)
     input_path = job_dir / f"{job_id}.pcd"
 
+    # стримим загрузку кусками, не блокируя event loop целиком
     with open(input_path, "wb") as f:
-        shutil.copyfileobj(file.file, f)
+        while chunk := await file.read(1 << 20):
+            f.write(chunk)
 
-    run_pipeline(input_path, job_dir)
-    results = collect_results(job_dir)
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(_EXECUTOR, run_pipeline, input_path, job_dir)
+    results = await loop.run_in_executor(_EXECUTOR, collect_results, job_dir)
+
+    # кешируем, чтобы GET /results не пересканировал job_dir каждый раз
+    _dump_json(results, job_dir / "results.json")
 
     return {
         "job_id": job_id,
@@ -194,7 +248,13 @@ async def get_results(job_id: str):
         raise HTTPException(status_code=404, detail="Job not found")
 
     try:
-        results = collect_results(job_dir)
+        # готовый results.json пишется в конце пайплайна; пересобираем,
+        # только если кеша нет (старые job'ы, прерванный пайплайн)
+        cache_file = job_dir / "results.json"
+        if cache_file.exists():
+            results = _load_json(cache_file)
+        else:
+            results = collect_results(job_dir)
         return {
             "job_id": job_id,
             "status": "done",
@@ -214,18 +274,16 @@ async def post_results(data: dict = Body(...)):
     if not job_dir.exists():
         raise HTTPException(status_code=404, detail=f"Job {job_id} not found")
 
-    # сохраняем json в bbox.json
+    # сохраняем json в bbox.json (человекочитаемым)
     bbox_file = job_dir / "bbox.json"
-    with open(bbox_file, "w") as f:
-        json.dump(data, f, indent=2)
+    _dump_json(data, bbox_file, indent=True)
 
     # пути к файлам
     input_file = job_dir / f"{job_id}.pcd"   # исходный .pcd
     output_file = job_dir / "result.pcd"     # результат
 
-    # запускаем process_pcd.py с input, bbox_file и output
-    run_step([
-        "python3", "process_pcd.py",
+    # применяем боксы in-process
+    run_step(process_main, [
         "--input", str(input_file),
         "--bbox_file", str(bbox_file),
         "--output", str(output_file)
@@ -3,17 +3,77 @@ import argparse
 import json
 import numpy as np
 import open3d as o3d
+from scipy.spatial import cKDTree
+
+try:
+    from _kernels import fuse_box_masks as _fuse_box_masks_nb
+except ImportError:
+    _fuse_box_masks_nb = None
+
+
+def _read_pcd_header(f):
+    """Парсит текстовый заголовок .pcd до строки DATA; возвращает dict полей."""
+    meta = {}
+    while True:
+        line = f.readline()
+        if not line:
+            raise ValueError("Unexpected EOF in PCD header")
+        text = line.decode("ascii", errors="ignore").strip()
+        if not text or text.startswith("#"):
+            continue
+        key, _, rest = text.partition(" ")
+        meta[key] = rest.split()
+        if key == "DATA":
+            return meta
 
 
 def load_pcd(path):
+    """
+    Быстрый путь: DATA binary читается np.fromfile прямо во float32,
+    без прохода через Open3D и лишней float64-копии.
+    ascii/binary_compressed и экзотические схемы полей — через o3d.
+    """
+    try:
+        with open(path, "rb") as f:
+            meta = _read_pcd_header(f)
+            fields = meta["FIELDS"]
+            counts = meta.get("COUNT", ["1"] * len(fields))
+            if (meta["DATA"][0] == "binary"
+                    and {"x", "y", "z"} <= set(fields)
+                    and all(c == "1" for c in counts)):
+                np_types = {"F": "f", "I": "i", "U": "u"}
+                dtype = np.dtype([(name, np_types[t] + s)
+                                  for name, t, s in zip(fields, meta["TYPE"], meta["SIZE"])])
+                raw = np.fromfile(f, dtype=dtype, count=int(meta["POINTS"][0]))
+                pts = np.empty((raw.shape[0], 3), dtype=np.float32)
+                pts[:, 0] = raw["x"]
+                pts[:, 1] = raw["y"]
+                pts[:, 2] = raw["z"]
+                return pts
+    except (ValueError, KeyError):
+        pass
     pcd = o3d.io.read_point_cloud(path)
-    return np.asarray(pcd.points)
+    return np.asarray(pcd.points, dtype=np.float32)
 
 
 def save_pcd(points, path):
-    pcd = o3d.geometry.PointCloud()
-    pcd.points = o3d.utility.Vector3dVector(points)
-    o3d.io.write_point_cloud(path, pcd)
+    pts = np.ascontiguousarray(points, dtype=np.float32)
+    header = (
+        "# .PCD v0.7 - Point Cloud Data file format\n"
+        "VERSION 0.7\n"
+        "FIELDS x y z\n"
+        "SIZE 4 4 4\n"
+        "TYPE F F F\n"
+        "COUNT 1 1 1\n"
+        f"WIDTH {pts.shape[0]}\n"
+        "HEIGHT 1\n"
+        "VIEWPOINT 0 0 0 1 0 0 0\n"
+        f"POINTS {pts.shape[0]}\n"
+        "DATA binary\n"
+    )
+    with open(path, "wb") as f:
+        f.write(header.encode("ascii"))
+        pts.tofile(f)
 
 
 def load_bboxes(path):
@@ -26,9 +86,10 @@ def convert_bbox_coords(center, size):
     cx, cy, cz = center
     sx, sy, sz = size
 
-    # Переводим в систему PCD (ROS)
-    center_new = np.array([cx, -cz, cy])
-    size_new   = np.array([sx, sz, sy])
+    # Переводим в систему PCD (ROS); float32, как и само облако —
+    # иначе каждая операция points-center молча апкастит всё во float64
+    center_new = np.array([cx, -cz, cy], dtype=np.float32)
+    size_new   = np.array([sx, sz, sy], dtype=np.float32)
     return center_new, size_new
 
 
@@ -38,10 +99,10 @@ def points_in_box(points, center, size, yaw):
     cos_y, sin_y = np.cos(-yaw), np.sin(-yaw)
     R = np.array([[cos_y, -sin_y, 0],
                   [sin_y,  cos_y, 0],
-                  [0,      0,     1]])
+                  [0,      0,     1]], dtype=np.float32)
     pts_rot = pts @ R.T
 
-    dx, dy, dz = np.array(size) / 2.0
+    dx, dy, dz = np.asarray(size, dtype=np.float32) / 2.0
 
     mask = (
         (np.abs(pts_rot[:, 0]) <= dx) &
@@ -65,27 +126,32 @@ def fill_surface_points(center, size, yaw, density=30):
     area = dx * dy
     n_points = int(area * density)
 
-    # равномерная генерация в пределах [-dx/2, dx/2], [-dy/2, dy/2]
-    xs = np.random.uniform(-dx/2, dx/2, n_points)
-    ys = np.random.uniform(-dy/2, dy/2, n_points)
-    zs = np.random.uniform(-dz/2, -dz/2 + dz_fill, n_points)
+    # одна аллокация RNG + масштабирование на месте
+    pts = np.random.random((n_points, 3)).astype(np.float32)
+    pts[:, 0] = pts[:, 0]*dx - dx/2
+    pts[:, 1] = pts[:, 1]*dy - dy/2
+    pts[:, 2] = pts[:, 2]*dz_fill - dz/2
 
-    pts = np.vstack([xs, ys, zs]).T
-
-    # Поворот обратно по yaw
+    # Поворот обратно по yaw — только вокруг Z, так что крутим лишь x,y
     cos_y, sin_y = np.cos(yaw), np.sin(yaw)
-    R = np.array([[cos_y, -sin_y, 0],
-                  [sin_y,  cos_y, 0],
-                  [0,      0,     1]])
-    pts_rot = pts @ R.T
+    x_rot = cos_y*pts[:, 0] - sin_y*pts[:, 1]
+    y_rot = sin_y*pts[:, 0] + cos_y*pts[:, 1]
 
     # Сдвиг в центр
-    pts_rot += center
+    pts[:, 0] = x_rot + center[0]
+    pts[:, 1] = y_rot + center[1]
+    pts[:, 2] += center[2]
 
-    return pts_rot
+    return pts
 
 
-def main(args):
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input", required=True, help="Path to input .pcd file")
+    parser.add_argument("--bbox_file", required=True, help="Path to bbox JSON file")
+    parser.add_argument("--output", required=True, help="Path to save filtered .pcd")
+    args = parser.parse_args(argv)
+
     print(f"[INFO] Loading input PCD: {args.input}")
     points = load_pcd(args.input)
     print(f"[INFO] Loaded {points.shape[0]} points")
@@ -93,27 +159,68 @@ def main(args):
     bboxes = load_bboxes(args.bbox_file)
     print(f"[INFO] Loaded {len(bboxes)} bounding boxes")
 
-    mask_remove = np.zeros(points.shape[0], dtype=bool)
-    new_points = []
-
-    for i, box in enumerate(bboxes):
+    # SoA-параметры всех боксов
+    boxes = []
+    for box in bboxes:
         center, size = convert_bbox_coords(box["center"], box["size"])
         yaw = float(box.get("yaw", 0.0))
-        fill_surface = bool(box.get("fill_surface", False))
+        boxes.append((center, size, yaw, bool(box.get("fill_surface", False))))
 
-        mask = points_in_box(points, center, size, yaw)
-        removed = mask.sum()
-        mask_remove |= mask
-        print(f"[INFO] Box {i}: removed {removed} points")
+    mask_remove = np.zeros(points.shape[0], dtype=bool)
+    if boxes:
+        # kd-дерево по облаку: каждый бокс трогает лишь точки в радиусе
+        # своей полудиагонали, а не весь скан
+        tree = cKDTree(points)
+        cand_lists = [
+            np.asarray(tree.query_ball_point(center, 0.5 * float(np.linalg.norm(size))),
+                       dtype=np.int64)
+            for center, size, _, _ in boxes
+        ]
+
+        if _fuse_box_masks_nb is not None:
+            # фьюзнутый numba-проход только по объединению кандидатов
+            cand = np.unique(np.concatenate(cand_lists))
+            if cand.size:
+                centers = np.array([b[0] for b in boxes], dtype=np.float32)
+                halves = np.array([np.asarray(b[1]) / 2.0 for b in boxes], dtype=np.float32)
+                cosy = np.array([np.cos(-b[2]) for b in boxes], dtype=np.float32)
+                siny = np.array([np.sin(-b[2]) for b in boxes], dtype=np.float32)
+                sub_owner = np.empty(cand.size, dtype=np.int32)
+                _fuse_box_masks_nb(points[cand], centers, halves, cosy, siny, sub_owner)
+                hit = sub_owner >= 0
+                mask_remove[cand[hit]] = True
+                removed_per_box = np.bincount(sub_owner[hit], minlength=len(boxes))
+            else:
+                removed_per_box = np.zeros(len(boxes), dtype=np.int64)
+            for i, removed in enumerate(removed_per_box):
+                print(f"[INFO] Box {i}: removed {removed} points")
+        else:
+            for i, ((center, size, yaw, _), cand) in enumerate(zip(boxes, cand_lists)):
+                removed = 0
+                if cand.size:
+                    sub = points_in_box(points[cand], center, size, yaw)
+                    mask_remove[cand[sub]] = True
+                    removed = int(sub.sum())
+                print(f"[INFO] Box {i}: removed {removed} points")
 
+    new_points = []
+    for i, (center, size, yaw, fill_surface) in enumerate(boxes):
         if fill_surface:
             pts_fill = fill_surface_points(center, size, yaw)
             new_points.append(pts_fill)
             print(f"[INFO] Box {i}: filled {pts_fill.shape[0]} points on surface")
 
-    points_filtered = points[~mask_remove]
-    if new_points:
-        points_filtered = np.vstack([points_filtered, *new_points])
+    # итог в один преаллоцированный буфер: compress пишет сразу в него,
+    # без промежуточной копии и vstack ещё одной полной копии
+    keep = ~mask_remove
+    n_keep = int(keep.sum())
+    n_fill = sum(p.shape[0] for p in new_points)
+    points_filtered = np.empty((n_keep + n_fill, 3), dtype=points.dtype)
+    np.compress(keep, points, axis=0, out=points_filtered[:n_keep])
+    ofs = n_keep
+    for pts_fill in new_points:
+        points_filtered[ofs:ofs + pts_fill.shape[0]] = pts_fill
+        ofs += pts_fill.shape[0]
 
     print(f"[INFO] Final points: {points_filtered.shape[0]}")
 
@@ -122,9 +229,4 @@ def main(args):
 
 
 if __name__ == "__main__":
-    parser = argparse.ArgumentParser()
-    parser.add_argument("--input", required=True, help="Path to input .pcd file")
-    parser.add_argument("--bbox_file", required=True, help="Path to bbox JSON file")
-    parser.add_argument("--output", required=True, help="Path to save filtered .pcd")
-    args = parser.parse_args()
-    main(args)
+    main()
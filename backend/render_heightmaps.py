@@ -1,285 +1,357 @@
-#!/usr/bin/env python3
-# -*- coding: utf-8 -*-
-
-"""
-Рендер PNG высотных карт для nonground-облаков по плоскостям из ground_report.json.
-
-- Проекция без вращения: XY остаётся глобальным, Z идёт в яркость (0..max_height).
-- Яркость = (z - z_plane(x,y)), где z_plane из Ax+By+Cz+D=0 (нормаль orient вверх).
-- Верхняя граница задаётся --max_height (м).
-  * --cap_mode clamp (по умолчанию): всё выше рисуется как max_height.
-  * --cap_mode drop: всё выше max_height игнорируется.
-- Для каждой PNG пишется .json c метаданными (origin, resolution, plane, масштаб).
-
-Зависимости: numpy, open3d, imageio (если нет imageio — fallback на Pillow).
-"""
-
-import argparse, os, re, json
-import numpy as np
-import open3d as o3d
-
-# --- изображение: попробуем imageio, иначе Pillow ---
-_writer = None
-def _init_writer():
-    global _writer
-    try:
-        import imageio.v2 as imageio
-        _writer = ("imageio", imageio)
-    except Exception:
-        try:
-            from PIL import Image
-            _writer = ("pil", Image)
-        except Exception as e:
-            raise RuntimeError("Need either imageio or Pillow installed to write PNG") from e
-
-def save_grayscale_png(path, arr_uint, bits=8):
-    """
-    arr_uint: np.ndarray dtype uint8 или uint16, 2D
-    """
-    if _writer is None:
-        _init_writer()
-    kind, mod = _writer
-    if kind == "imageio":
-        mod.imwrite(path, arr_uint)
-    else:
-        # PIL
-        if bits == 8:
-            im = mod.fromarray(arr_uint, mode="L")
-        elif bits == 16:
-            # 'I;16' — 16-bit grayscale
-            im = mod.fromarray(arr_uint, mode="I;16")
-        else:
-            raise ValueError("bits must be 8 or 16")
-        im.save(path, format="PNG", optimize=True)
-
-def load_planes(path):
-    with open(path, "r") as f:
-        data = json.load(f)
-    # Поддержка двух форматов:
-    # 1) { "0": {...}, "1": {...} }  (как в твоём report_json)
-    # 2) { "planes": {...} }
-    if "planes" in data and isinstance(data["planes"], dict):
-        return {int(k): v for k, v in data["planes"].items()}
-    else:
-        return {int(k): v for k, v in data.items()}
-
-def parse_cid_from_name(name):
-    # ожидаем cluster_XXXX_*.pcd
-    m = re.search(r"cluster_(\d+)", name)
-    return int(m.group(1)) if m else None
-
-def plane_z_at_xy(n, D, x, y):
-    # n=(A,B,C) уже нормирована и ориентирована вверх
-    C = n[2]
-    if abs(C) < 1e-9:
-        return None
-    return (-D - n[0]*x - n[1]*y) / C
-
-def rasterize_height(x, y, h, res, bg_value=0):
-    """
-    Растеризация max-height в сетку (без вращения).
-    x,y,h — 1D массивы одинаковой длины
-    res — размер пикселя, м/пикс.
-    Возвращает (img(H,W), origin_x, origin_y)
-    """
-    if len(x) == 0:
-        return np.zeros((1,1), np.uint8), 0.0, 0.0
-
-    minx, maxx = float(np.min(x)), float(np.max(x))
-    miny, maxy = float(np.min(y)), float(np.max(y))
-
-    # добавим крошечные поля, чтобы не было выхода за границы округления
-    eps = 1e-6
-    minx -= eps; miny -= eps
-
-    W = int(np.ceil((maxx - minx) / res))
-    H = int(np.ceil((maxy - miny) / res))
-    W = max(W, 1); H = max(H, 1)
-
-    ix = np.floor((x - minx) / res).astype(np.int32)
-    iy = np.floor((y - miny) / res).astype(np.int32)
-    # clip на всякий случай
-    ix = np.clip(ix, 0, W-1)
-    iy = np.clip(iy, 0, H-1)
-
-    # накапливаем максимум по высоте
-    img = np.full((H, W), -np.inf, dtype=np.float32)
-    # векторизованно: выберем "линейный индекс"
-    lin = iy * W + ix
-    # отсортируем по линейному индексу, затем возьмём максимум в группе
-    order = np.argsort(lin)
-    lin_sorted = lin[order]
-    h_sorted = h[order]
-
-    # проход по группам
-    start = 0
-    while start < lin_sorted.size:
-        end = start + 1
-        key = lin_sorted[start]
-        while end < lin_sorted.size and lin_sorted[end] == key:
-            end += 1
-        # максимум на этом ключе
-        max_h = float(np.max(h_sorted[start:end]))
-        iy_k = key // W
-        ix_k = key % W
-        img[iy_k, ix_k] = max(img[iy_k, ix_k], max_h)
-        start = end
-
-    # пустые клетки → 0
-    img[~np.isfinite(img)] = 0.0
-    return img, minx, miny
-
-def main():
-    ap = argparse.ArgumentParser()
-    ap.add_argument("--indir", required=True, help="Папка датасета (где ground_report.json, split_pcd/...)")
-    ap.add_argument("--planes_json", type=str, default="ground_report.json")
-    ap.add_argument("--nonground_dir", type=str, default="split_pcd/nonground")
-    ap.add_argument("--outdir", type=str, default="heightmaps")
-    ap.add_argument("--res", type=float, default=0.10, help="Размер пикселя, м/px")
-    ap.add_argument("--max_height", type=float, default=5.0, help="Верхняя граница (м)")
-    ap.add_argument("--cap_mode", type=str, default="clamp", choices=["clamp","drop"],
-                    help="clamp: значения > max_height прижимаются к max_height; drop: такие точки игнорируются")
-    ap.add_argument("--bits", type=int, default=8, choices=[8,16], help="Глубина PNG (8 или 16 бит)")
-    ap.add_argument("--bg_value", type=int, default=0, help="Яркость фона (0..255 или 0..65535)")
-    args = ap.parse_args()
-
-    planes_path = os.path.join(args.indir, args.planes_json)
-    ng_dir = os.path.join(args.indir, args.nonground_dir)
-    out_dir = os.path.join(args.indir, args.outdir)
-    os.makedirs(out_dir, exist_ok=True)
-
-    planes = load_planes(planes_path)
-
-    # Соберём список nonground-файлов
-    if not os.path.isdir(ng_dir):
-        raise RuntimeError(f"Not found nonground dir: {ng_dir}")
-    pcd_files = [os.path.join(ng_dir, f) for f in os.listdir(ng_dir) if f.endswith(".pcd")]
-    pcd_files.sort()
-
-    print(f"[*] Planes: {len(planes)}, nonground PCDs: {len(pcd_files)}")
-    _init_writer()
-
-    maxval = 255 if args.bits == 8 else 65535
-
-    index = []  # для сводного index.json
-
-    for pcd_path in pcd_files:
-        name = os.path.basename(pcd_path)
-        cid = parse_cid_from_name(name)
-        if cid is None or cid not in planes:
-            print(f"[!] Skip {name}: cid not found in planes")
-            continue
-
-        plane = planes[cid]
-        n = np.array(plane["n"], dtype=float)  # A,B,C
-        D = float(plane["D"])
-        if n[2] <= 0:
-            # на всякий случай — ориент вверх
-            n *= -1.0
-            D *= -1.0
-
-        # читаем nonground-точки
-        pcd = o3d.io.read_point_cloud(pcd_path)
-        pts = np.asarray(pcd.points)
-        if pts.shape[0] == 0:
-            print(f"[i] Empty nonground: {name}")
-            # создадим пустую 1x1 картинку и метаданные
-            img = np.zeros((1,1), np.uint8 if args.bits==8 else np.uint16)
-            png_path = os.path.join(out_dir, f"{os.path.splitext(name)[0]}.png")
-            save_grayscale_png(png_path, img, bits=args.bits)
-            meta = {
-                "cid": cid,
-                "png": os.path.basename(png_path),
-                "width": 1, "height": 1,
-                "resolution": args.res,
-                "origin_xy": [0.0, 0.0],
-                "plane": {"n": n.tolist(), "D": D},
-                "max_height": args.max_height,
-                "cap_mode": args.cap_mode,
-                "bits": args.bits
-            }
-            with open(os.path.join(out_dir, f"{os.path.splitext(name)[0]}.json"), "w") as f:
-                json.dump(meta, f, indent=2)
-            index.append(meta)
-            continue
-
-        # посчитаем высоту относительно плоскости
-        x, y, z = pts[:,0], pts[:,1], pts[:,2]
-        zpl = plane_z_at_xy(n, D, x, y)
-        if zpl is None:
-            print(f"[!] Plane C≈0 (vertical), skip {name}")
-            continue
-        h = z - zpl  # >= 0 (nonground выше плоскости), но на всякий случай обрежем
-        h = np.maximum(h, 0.0)
-
-        # применим верхний лимит
-        if args.cap_mode == "drop":
-            mask = h <= args.max_height
-            x, y, h = x[mask], y[mask], h[mask]
-        else:
-            # clamp
-            h = np.minimum(h, args.max_height)
-
-        if h.size == 0:
-            # все точки выше лимита и отброшены
-            img = np.zeros((1,1), np.uint8 if args.bits==8 else np.uint16)
-            png_path = os.path.join(out_dir, f"{os.path.splitext(name)[0]}.png")
-            save_grayscale_png(png_path, img, bits=args.bits)
-            meta = {
-                "cid": cid,
-                "png": os.path.basename(png_path),
-                "width": 1, "height": 1,
-                "resolution": args.res,
-                "origin_xy": [0.0, 0.0],
-                "plane": {"n": n.tolist(), "D": D},
-                "max_height": args.max_height,
-                "cap_mode": args.cap_mode,
-                "bits": args.bits
-            }
-            with open(os.path.join(out_dir, f"{os.path.splitext(name)[0]}.json"), "w") as f:
-                json.dump(meta, f, indent=2)
-            index.append(meta)
-            continue
-
-        # растеризуем максимум высоты в клетке
-        Hgrid, ox, oy = rasterize_height(x, y, h, res=args.res)
-        # нормируем в 0..maxval
-        img_f = (Hgrid / float(args.max_height)) * float(maxval)
-        img_f = np.clip(img_f, 0, maxval)
-        arr_uint = img_f.astype(np.uint8 if args.bits==8 else np.uint16)
-
-        # фон туда, где пусто (0 уже и так фон), оставим как есть
-        if args.bg_value != 0:
-            arr_uint[Hgrid == 0] = np.uint16(args.bg_value) if args.bits==16 else np.uint8(args.bg_value)
-
-        # сохраняем
-        stem = os.path.splitext(name)[0]  # cluster_XXXX_nonground
-        png_path = os.path.join(out_dir, f"{stem}.png")
-        save_grayscale_png(png_path, arr_uint, bits=args.bits)
-
-        meta = {
-            "cid": cid,
-            "png": os.path.basename(png_path),
-            "width": int(arr_uint.shape[1]),
-            "height": int(arr_uint.shape[0]),
-            "resolution": args.res,            # м/пиксель
-            "origin_xy": [ox, oy],             # левый-нижний угол сетки в глобальных XY
-            "plane": {"n": n.tolist(), "D": D},
-            "max_height": args.max_height,
-            "cap_mode": args.cap_mode,
-            "bits": args.bits,
-            "scale": {"min_height": 0.0, "max_height": args.max_height, "maxval": int(maxval)}
-        }
-        with open(os.path.join(out_dir, f"{stem}.json"), "w") as f:
-            json.dump(meta, f, indent=2)
-
-        index.append(meta)
-        print(f"[+] {name} -> {os.path.basename(png_path)}  ({arr_uint.shape[1]}x{arr_uint.shape[0]})")
-
-    # общий индекс
-    with open(os.path.join(out_dir, "index.json"), "w") as f:
-        json.dump({"items": index}, f, indent=2)
-    print(f"[*] Done. Wrote {len(index)} PNG + JSON to {out_dir}")
-    
-if __name__ == "__main__":
-    main()
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Рендер PNG высотных карт для nonground-облаков по плоскостям из ground_report.json.
+
+- Проекция без вращения: XY остаётся глобальным, Z идёт в яркость (0..max_height).
+- Яркость = (z - z_plane(x,y)), где z_plane из Ax+By+Cz+D=0 (нормаль orient вверх).
+- Верхняя граница задаётся --max_height (м).
+  * --cap_mode clamp (по умолчанию): всё выше рисуется как max_height.
+  * --cap_mode drop: всё выше max_height игнорируется.
+- Для каждой PNG пишется .json c метаданными (origin, resolution, plane, масштаб).
+
+Зависимости: numpy, open3d, imageio (если нет imageio — fallback на Pillow).
+"""
+
+import argparse, functools, multiprocessing, os, re, json
+import numpy as np
+import open3d as o3d
+
+try:
+    from _kernels import rasterize_max as _rasterize_max_nb
+except ImportError:
+    _rasterize_max_nb = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+def _dump_json(obj, path):
+    # метаданные смотрят глазами — indent сохраняем и в orjson-ветке
+    if orjson is not None:
+        with open(path, "wb") as f:
+            f.write(orjson.dumps(obj, option=orjson.OPT_INDENT_2 | orjson.OPT_SERIALIZE_NUMPY))
+    else:
+        with open(path, "w") as f:
+            json.dump(obj, f, indent=2)
+
+# --- изображение: попробуем imageio, иначе Pillow ---
+_writer = None
+def _init_writer():
+    global _writer
+    try:
+        import imageio.v2 as imageio
+        _writer = ("imageio", imageio)
+    except Exception:
+        try:
+            from PIL import Image
+            _writer = ("pil", Image)
+        except Exception as e:
+            raise RuntimeError("Need either imageio or Pillow installed to write PNG") from e
+
+def save_grayscale_png(path, arr_uint, bits=8):
+    """
+    arr_uint: np.ndarray dtype uint8 или uint16, 2D
+    """
+    if _writer is None:
+        _init_writer()
+    kind, mod = _writer
+    # compress_level=1: карты в основном нулевые, zlib на максимуме жмёт
+    # их в разы дольше при почти том же размере файла
+    if kind == "imageio":
+        try:
+            mod.imwrite(path, arr_uint, compress_level=1)
+        except TypeError:
+            # бэкенд без поддержки compress_level
+            mod.imwrite(path, arr_uint)
+    else:
+        # PIL
+        if bits == 8:
+            im = mod.fromarray(arr_uint, mode="L")
+        elif bits == 16:
+            # 'I;16' — 16-bit grayscale
+            im = mod.fromarray(arr_uint, mode="I;16")
+        else:
+            raise ValueError("bits must be 8 or 16")
+        im.save(path, format="PNG", compress_level=1)
+
+def load_planes(path):
+    if orjson is not None:
+        with open(path, "rb") as f:
+            data = orjson.loads(f.read())
+    else:
+        with open(path, "r") as f:
+            data = json.load(f)
+    # Поддержка двух форматов:
+    # 1) { "0": {...}, "1": {...} }  (как в твоём report_json)
+    # 2) { "planes": {...} }
+    if "planes" in data and isinstance(data["planes"], dict):
+        return {int(k): v for k, v in data["planes"].items()}
+    else:
+        return {int(k): v for k, v in data.items()}
+
+def parse_cid_from_name(name):
+    # ожидаем cluster_XXXX_*.pcd
+    m = re.search(r"cluster_(\d+)", name)
+    return int(m.group(1)) if m else None
+
+def read_pcd_fast(pcd_path):
+    """
+    Nx3 float32 без Open3D: сначала .npy-сайдкар от ground_detection (mmap),
+    иначе memmap прямо на бинарный хвост .pcd (заголовок — текст, дальше
+    сырые float32 x y z ...). Нестандартные схемы полей — fallback на o3d.
+    """
+    npy = os.path.splitext(pcd_path)[0] + ".npy"
+    if os.path.exists(npy):
+        return np.load(npy, mmap_mode="r")
+    try:
+        with open(pcd_path, "rb") as f:
+            meta = {}
+            while True:
+                line = f.readline()
+                if not line:
+                    raise ValueError("Unexpected EOF in PCD header")
+                text = line.decode("ascii", errors="ignore").strip()
+                if not text or text.startswith("#"):
+                    continue
+                key, _, rest = text.partition(" ")
+                meta[key] = rest.split()
+                if key == "DATA":
+                    offset = f.tell()
+                    break
+        fields = meta["FIELDS"]
+        if (meta["DATA"][0] == "binary"
+                and fields[:3] == ["x", "y", "z"]
+                and all(t == "F" for t in meta["TYPE"])
+                and all(s == "4" for s in meta["SIZE"])
+                and all(c == "1" for c in meta.get("COUNT", ["1"] * len(fields)))):
+            n_pts = int(meta["POINTS"][0])
+            mm = np.memmap(pcd_path, offset=offset, dtype=np.float32, mode="r",
+                           shape=(n_pts, len(fields)))
+            return mm[:, :3]
+    except (ValueError, KeyError):
+        pass
+    pcd = o3d.io.read_point_cloud(pcd_path)
+    return np.asarray(pcd.points, dtype=np.float32)
+
+def rasterize_height(x, y, h, res, bg_value=0):
+    """
+    Растеризация max-height в сетку (без вращения).
+    x,y,h — 1D массивы одинаковой длины
+    res — размер пикселя, м/пикс.
+    Возвращает (img(H,W), origin_x, origin_y)
+    """
+    if len(x) == 0:
+        return np.zeros((1,1), np.uint8), 0.0, 0.0
+
+    minx, maxx = float(np.min(x)), float(np.max(x))
+    miny, maxy = float(np.min(y)), float(np.max(y))
+
+    # добавим крошечные поля, чтобы не было выхода за границы округления
+    eps = 1e-6
+    minx -= eps; miny -= eps
+
+    W = int(np.ceil((maxx - minx) / res))
+    H = int(np.ceil((maxy - miny) / res))
+    W = max(W, 1); H = max(H, 1)
+
+    # при наличии numba — JIT-ядро: ix/iy/клип/scatter-max в одном цикле,
+    # совсем без временных индексных массивов
+    if _rasterize_max_nb is not None:
+        img = np.zeros((H, W), dtype=np.float32)
+        _rasterize_max_nb(np.ascontiguousarray(x, dtype=np.float32),
+                          np.ascontiguousarray(y, dtype=np.float32),
+                          np.ascontiguousarray(h, dtype=np.float32),
+                          np.float32(minx), np.float32(miny), np.float32(res), img)
+        return img, minx, miny
+
+    ix = np.floor((x - minx) / res).astype(np.int32)
+    iy = np.floor((y - miny) / res).astype(np.int32)
+    # clip на всякий случай
+    ix = np.clip(ix, 0, W-1)
+    iy = np.clip(iy, 0, H-1)
+
+    # накапливаем максимум по высоте одним scatter-проходом: без argsort
+    # (O(N log N)) и без unique — h >= 0, так что нулевая инициализация
+    # одновременно даёт фон пустых клеток
+    lin = iy * W + ix
+    flat = np.zeros(H * W, dtype=np.float32)
+    np.maximum.at(flat, lin, h)
+    img = flat.reshape(H, W)
+    return img, minx, miny
+
+def _bucket32(v):
+    # ближайшее сверху кратное 32 (страйд YOLO): PNG с одинаковым бакетом
+    # можно стакать в один батч без ресайза
+    return max(32, ((int(v) + 31) // 32) * 32)
+
+def _write_meta(meta, out_dir, stem):
+    _dump_json(meta, os.path.join(out_dir, f"{stem}.json"))
+
+def process_one(pcd_path, planes, args, out_dir):
+    """
+    Полная обработка одного nonground-PCD: чтение, высоты, растеризация,
+    PNG + JSON. Возвращает meta (или None, если файл пропущен).
+    Файлы независимы, поэтому вызывается из пула процессов.
+    """
+    maxval = 255 if args.bits == 8 else 65535
+    name = os.path.basename(pcd_path)
+    stem = os.path.splitext(name)[0]  # cluster_XXXX_nonground
+    cid = parse_cid_from_name(name)
+    if cid is None or cid not in planes:
+        print(f"[!] Skip {name}: cid not found in planes")
+        return None
+
+    plane = planes[cid]
+    n = np.array(plane["n"], dtype=float)  # A,B,C
+    D = float(plane["D"])
+    if n[2] <= 0:
+        # на всякий случай — ориент вверх
+        n *= -1.0
+        D *= -1.0
+
+    empty_meta = {
+        "cid": cid,
+        "png": f"{stem}.png",
+        "width": 1, "height": 1,
+        "resolution": args.res,
+        "origin_xy": [0.0, 0.0],
+        "plane": {"n": n.tolist(), "D": D},
+        "max_height": args.max_height,
+        "cap_mode": args.cap_mode,
+        "bits": args.bits
+    }
+
+    # читаем nonground-точки (сайдкар/memmap вместо полного декода Open3D)
+    pts = read_pcd_fast(pcd_path)
+    if pts.shape[0] == 0:
+        print(f"[i] Empty nonground: {name}")
+        # создадим пустую 1x1 картинку и метаданные
+        img = np.zeros((1,1), np.uint8 if args.bits==8 else np.uint16)
+        save_grayscale_png(os.path.join(out_dir, f"{stem}.png"), img, bits=args.bits)
+        _write_meta(empty_meta, out_dir, stem)
+        return empty_meta
+
+    # посчитаем высоту относительно плоскости:
+    # h = z - (-D - A*x - B*y)/C = z + (A/C)x + (B/C)y + D/C.
+    # Считаем накоплением в один рабочий буфер вместо четырёх временных
+    # N-массивов (каждый += — один проход по памяти)
+    C = n[2]
+    if abs(C) < 1e-9:
+        print(f"[!] Plane C≈0 (vertical), skip {name}")
+        return None
+    x, y, z = pts[:,0], pts[:,1], pts[:,2]
+    h = x * np.float32(n[0] / C)
+    h += y * np.float32(n[1] / C)
+    h += np.float32(D / C)
+    h += z
+    np.maximum(h, 0.0, out=h)  # nonground выше плоскости, но на всякий случай
+
+    # применим верхний лимит
+    if args.cap_mode == "drop":
+        # один индексный массив вместо bool-маски + трёх fancy-index проходов
+        idx = np.where(h <= args.max_height)[0]
+        x, y, h = x[idx], y[idx], h[idx]
+    else:
+        # clamp
+        h = np.minimum(h, args.max_height)
+
+    if h.size == 0:
+        # все точки выше лимита и отброшены
+        img = np.zeros((1,1), np.uint8 if args.bits==8 else np.uint16)
+        save_grayscale_png(os.path.join(out_dir, f"{stem}.png"), img, bits=args.bits)
+        _write_meta(empty_meta, out_dir, stem)
+        return empty_meta
+
+    # растеризуем максимум высоты в клетке
+    Hgrid, ox, oy = rasterize_height(x, y, h, res=args.res)
+    # нормируем в 0..maxval на месте: Hgrid — свежий буфер растеризации,
+    # так что не плодим три временных массива размером с сетку
+    np.multiply(Hgrid, float(maxval) / float(args.max_height), out=Hgrid)
+    np.clip(Hgrid, 0, maxval, out=Hgrid)
+    arr_uint = Hgrid.astype(np.uint8 if args.bits==8 else np.uint16)
+
+    # фон туда, где пусто (0 уже и так фон), оставим как есть
+    if args.bg_value != 0:
+        arr_uint[Hgrid == 0] = np.uint16(args.bg_value) if args.bits==16 else np.uint8(args.bg_value)
+
+    # сохраняем
+    png_path = os.path.join(out_dir, f"{stem}.png")
+    save_grayscale_png(png_path, arr_uint, bits=args.bits)
+
+    meta = {
+        "cid": cid,
+        "png": os.path.basename(png_path),
+        "width": int(arr_uint.shape[1]),
+        "height": int(arr_uint.shape[0]),
+        "resolution": args.res,            # м/пиксель
+        "origin_xy": [ox, oy],             # левый-нижний угол сетки в глобальных XY
+        "plane": {"n": n.tolist(), "D": D},
+        "max_height": args.max_height,
+        "cap_mode": args.cap_mode,
+        "bits": args.bits,
+        "scale": {"min_height": 0.0, "max_height": args.max_height, "maxval": int(maxval)}
+    }
+    _write_meta(meta, out_dir, stem)
+    print(f"[+] {name} -> {os.path.basename(png_path)}  ({arr_uint.shape[1]}x{arr_uint.shape[0]})")
+    return meta
+
+def main(argv=None):
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--indir", required=True, help="Папка датасета (где ground_report.json, split_pcd/...)")
+    ap.add_argument("--planes_json", type=str, default="ground_report.json")
+    ap.add_argument("--nonground_dir", type=str, default="split_pcd/nonground")
+    ap.add_argument("--outdir", type=str, default="heightmaps")
+    ap.add_argument("--res", type=float, default=0.10, help="Размер пикселя, м/px")
+    ap.add_argument("--max_height", type=float, default=5.0, help="Верхняя граница (м)")
+    ap.add_argument("--cap_mode", type=str, default="clamp", choices=["clamp","drop"],
+                    help="clamp: значения > max_height прижимаются к max_height; drop: такие точки игнорируются")
+    ap.add_argument("--bits", type=int, default=8, choices=[8,16], help="Глубина PNG (8 или 16 бит)")
+    ap.add_argument("--bg_value", type=int, default=0, help="Яркость фона (0..255 или 0..65535)")
+    args = ap.parse_args(argv)
+
+    planes_path = os.path.join(args.indir, args.planes_json)
+    ng_dir = os.path.join(args.indir, args.nonground_dir)
+    out_dir = os.path.join(args.indir, args.outdir)
+    os.makedirs(out_dir, exist_ok=True)
+
+    planes = load_planes(planes_path)
+
+    # Соберём список nonground-файлов
+    if not os.path.isdir(ng_dir):
+        raise RuntimeError(f"Not found nonground dir: {ng_dir}")
+    pcd_files = [os.path.join(ng_dir, f) for f in os.listdir(ng_dir) if f.endswith(".pcd")]
+    pcd_files.sort()
+
+    print(f"[*] Planes: {len(planes)}, nonground PCDs: {len(pcd_files)}")
+    _init_writer()
+
+    # файлы независимы → обрабатываем пулом процессов
+    # (spawn вместо fork: стадию зовут in-process из потока uvicorn'а,
+    # fork живого процесса с загруженными torch/CUDA — дедлок)
+    index = []  # для сводного index.json
+    worker = functools.partial(process_one, planes=planes, args=args, out_dir=out_dir)
+    with multiprocessing.get_context("spawn").Pool(processes=os.cpu_count()) as pool:
+        for meta in pool.imap_unordered(worker, pcd_files):
+            if meta is not None:
+                index.append(meta)
+    index.sort(key=lambda m: m["cid"])  # imap_unordered перемешивает порядок
+
+    # общий индекс
+    _dump_json({"items": index}, os.path.join(out_dir, "index.json"))
+
+    # batches.json: группы PNG по бакетам формы — даунстрим-инференс может
+    # прогонять каждую группу одним батч-форвардом вместо картинки за раз
+    buckets = {}
+    for m in index:
+        key = (_bucket32(m["width"]), _bucket32(m["height"]))
+        buckets.setdefault(key, []).append(m["png"])
+    batches = [{"width": w, "height": h, "images": imgs}
+               for (w, h), imgs in sorted(buckets.items())]
+    _dump_json({"batches": batches}, os.path.join(out_dir, "batches.json"))
+    print(f"[*] Done. Wrote {len(index)} PNG + JSON to {out_dir}")
+    
+if __name__ == "__main__":
+    main()